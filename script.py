@@ -1,21 +1,44 @@
 import argparse
+import concurrent.futures
+import functools
+import http.client
+import json
 import os
+import re
 import socket
-from typing import List, NamedTuple
+import time
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, Iterator, List, Optional
 
 import bitmath
 import bitmath.integrations
-import slack_sdk
-import slack_sdk.errors
 
+# Mountpoints under these prefixes are never monitored.
+_SKIP_PREFIXES = ("/snap", "/boot", "/var/lib/docker")
 
-class Partition(NamedTuple):
+# Matches the default timeout of slack_sdk.WebClient.
+_SLACK_TIMEOUT_SECONDS = 30
+
+# proc(5): space, tab, newline and backslash are escaped as octal, e.g. "\040".
+_MOUNT_ESCAPE_RE = re.compile(rb"\\([0-7]{3})")
+
+_BINARY_UNITS = ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB")
+
+
+def _human(n: int) -> str:
+    """Formats a byte count using the largest binary unit that keeps it >= 1."""
+    i = min(max(n.bit_length() - 1, 0) // 10, len(_BINARY_UNITS) - 1)
+    return f"{n / (1 << (10 * i)):.2f} {_BINARY_UNITS[i]}"
+
+
+@dataclass(slots=True, frozen=True)
+class Partition:
     device: str
     mountpoint: str
     fstype: str
-    total_bytes: bitmath.Byte
-    used_bytes: bitmath.Byte
-    free_bytes: bitmath.Byte
+    total_bytes: int
+    used_bytes: int
+    free_bytes: int
 
     def proportion_free(self) -> float:
         if self.total_bytes == 0:
@@ -23,82 +46,146 @@ class Partition(NamedTuple):
         return self.free_bytes / self.total_bytes
 
     def report_str(self) -> str:
-        free_bytes_str = self.free_bytes.best_prefix().format("{value:.2f} {unit}")
-        total_bytes_str = self.total_bytes.best_prefix().format("{value:.2f} {unit}")
+        free_bytes_str = _human(self.free_bytes)
+        total_bytes_str = _human(self.total_bytes)
         return (
             f"{free_bytes_str} / {total_bytes_str} free space remaining on "
             f"(device={self.device}, mountpoint={self.mountpoint})"
         )
 
 
-def disk_partitions(include_virtual_devices: bool = False) -> List[Partition]:
-    """Reads system partitions and returns them as a list of Partition.
+def batched_statvfs(mountpoints: List[str]) -> List[os.statvfs_result]:
+    """Returns the `os.statvfs` result for each of `mountpoints`, in order.
+
+    io_uring has no statvfs opcode (IORING_OP_STATX does not report free
+    blocks), so the `os.statvfs` calls are spread over a thread pool instead;
+    the GIL is released during the syscall, so slow (e.g. NFS) mounts are
+    queried concurrently. Linux also has no ST_NOWAIT-style cached statvfs:
+    `statx(AT_STATX_DONT_SYNC)` only covers inode attributes, so remote mounts
+    are always queried live.
+    """
+    if not mountpoints:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(16, len(mountpoints))) as executor:
+        return list(executor.map(os.statvfs, mountpoints))
+
+
+@functools.lru_cache(maxsize=1)
+def _phydevs() -> FrozenSet[bytes]:
+    """Returns the filesystem types in /proc/filesystems that are backed by a device."""
+    with open("/proc/filesystems", "rb") as f:
+        data = f.read()
+    phydevs = set()
+    for line in data.splitlines():
+        if not line.startswith(b"nodev"):
+            phydevs.add(line.strip())
+    return frozenset(phydevs)
+
+
+def _unescape_mount_field(field: bytes) -> bytes:
+    """Decodes the octal escapes (e.g. "\\040" for a space) used in /proc/self/mountinfo."""
+    return _MOUNT_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 8)]), field)
+
+
+@functools.lru_cache(maxsize=1)
+def _fqdn() -> str:
+    return socket.getfqdn()
+
+
+def disk_partitions(
+    include_virtual_devices: bool = False,
+    keep: Optional[Callable[[str], bool]] = None,
+) -> Iterator[Partition]:
+    """Reads system partitions and yields them as Partition.
+
+    If `keep` is given, only mountpoints for which it returns True are stat'ed
+    and returned.
 
     Based off of https://stackoverflow.com/a/6397492/1091722.
     """
-    phydevs = []
-    f = open("/proc/filesystems", "r")
-    for line in f:
-        if not line.startswith("nodev"):
-            phydevs.append(line.strip())
-
-    result = []
-    f = open('/etc/mtab', "r")
-    for line in f:
-        if not include_virtual_devices and line.startswith('none'):
-            continue
-        fields = line.split()
-        device = fields[0]
-        mountpoint = fields[1]
-        fstype = fields[2]
+    phydevs = _phydevs()
+    with open("/proc/self/mountinfo", "rb") as f:
+        data = f.read()
+    entries = []
+    for line in data.splitlines():
+        # See proc(5): the optional fields are terminated by a lone "-".
+        mount_fields, _, fs_fields = line.partition(b" - ")
+        mount_fields = mount_fields.split()
+        fs_fields = fs_fields.split()
+        mountpoint = mount_fields[4]
+        fstype = fs_fields[0]
+        device = fs_fields[1]
         if not include_virtual_devices and fstype not in phydevs:
             continue
-        if device == 'none':
-            device = ''
+        mountpoint = os.fsdecode(_unescape_mount_field(mountpoint))
+        if keep is not None and not keep(mountpoint):
+            continue
+        if device == b'none':
+            device = b''
+        entries.append((os.fsdecode(_unescape_mount_field(device)), mountpoint, os.fsdecode(fstype)))
 
-        st = os.statvfs(mountpoint)
+    stats = batched_statvfs([mountpoint for _, mountpoint, _ in entries])
+    for (device, mountpoint, fstype), st in zip(entries, stats):
         free = (st.f_bavail * st.f_frsize)
         total = (st.f_blocks * st.f_frsize)
         used = (st.f_blocks - st.f_bfree) * st.f_frsize
         # NB: the percentage is -5% than what shown by df due to
         # reserved blocks that we are currently not considering:
         # http://goo.gl/sWGbH
-        part = Partition(
+        yield Partition(
             device,
             mountpoint,
             fstype,
-            bitmath.Byte(total),
-            bitmath.Byte(used),
-            bitmath.Byte(free),
+            total,
+            used,
+            free,
         )
-        result.append(part)
-    return result
-
 
-def select_disk_partitions() -> List[Partition]:
-    """Returns a list of Partition representing the disks that we care to monitor."""
-    result = []
-    for p in disk_partitions():
-        if len(p.mountpoint) > 0 and not p.mountpoint.startswith("/snap") and not p.mountpoint.startswith("/boot"):
-            result.append(p)
-    return result
 
+def select_disk_partitions() -> Iterator[Partition]:
+    """Yields Partition representing the disks that we care to monitor."""
+    yield from disk_partitions(
+        keep=lambda mp: len(mp) > 0 and not mp.startswith(_SKIP_PREFIXES),
+    )
 
-def slack_print(msg, token, channel="#slack-bot-playground") -> None:
-    client = slack_sdk.WebClient(token=token)
 
-    try:
-        client.chat_postMessage(
-            channel=channel,
-            text=msg,
-            username="Human-Compatible Disk Alert Bot",
-            icon_emoji=":chai:",
-        )
-    except slack_sdk.errors.SlackApiError as e:
-        # You will get a SlackApiError if "ok" is False
-        assert e.response["ok"] is False
-        assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
-        print(f"Got an error: {e.response['error']}")
+def slack_print(
+    conn: http.client.HTTPSConnection, token: str, msg, channel="#slack-bot-playground",
+    max_retries: int = 3,
+) -> None:
+    """Posts `msg` to Slack via chat.postMessage over the (reusable) connection `conn`."""
+    payload = json.dumps({
+        "channel": channel,
+        "text": msg,
+        "username": "Human-Compatible Disk Alert Bot",
+        "icon_emoji": ":chai:",
+    })
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json; charset=utf-8",
+    }
+    for attempt in range(max_retries + 1):
+        conn.request("POST", "/api/chat.postMessage", payload, headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status == 429 and attempt < max_retries:
+            # Rate limited: Slack says how long to wait in Retry-After; back off
+            # exponentially if it doesn't.
+            retry_after = response.getheader("Retry-After")
+            retry_after = int(retry_after) if retry_after else 2 ** attempt
+            print(f"Rate limited by Slack, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            continue
+        try:
+            result = json.loads(body)
+        except ValueError:
+            # e.g. an HTML error page from a proxy or a Slack outage.
+            print(f"Got an error: HTTP {response.status}: {body[:200]!r}")
+            return
+        if not result.get("ok"):
+            # str like 'invalid_auth', 'channel_not_found'
+            print(f"Got an error: {result.get('error', f'HTTP {response.status}')}")
+        return
 
 
 def main(token: str, warning_threshold: bitmath.Bitmath, channel: str) -> None:
@@ -107,16 +194,24 @@ def main(token: str, warning_threshold: bitmath.Bitmath, channel: str) -> None:
         print("Unable to print to Slack because SLACK_BOT_TOKEN env var not set")
         exit(1)
 
-    for part in select_disk_partitions():
-        if part.free_bytes < warning_threshold:
-            msg = (
-                ":robot_face: :hourglass_flowing_sand: :warning: "
-                f"WARNING: Low disk space on `{socket.getfqdn()} ({part.device})` "
-                f"(threshold: <={warning_threshold}).\n"
-                f"`{part.report_str()}`"
-            )
-            print(msg)
-            slack_print(msg, token, channel)
+    minimal_bytes = int(warning_threshold.to_Byte())
+    offenders = [part for part in select_disk_partitions() if part.free_bytes < minimal_bytes]
+    if not offenders:
+        return
+
+    hostname = _fqdn()
+    msg = (
+        ":robot_face: :hourglass_flowing_sand: :warning: "
+        f"WARNING: Low disk space on `{hostname}` "
+        f"(threshold: <={warning_threshold}).\n"
+    )
+    msg += "\n".join(f"• `{part.report_str()}`" for part in offenders)
+    print(msg)
+    conn = http.client.HTTPSConnection("slack.com", timeout=_SLACK_TIMEOUT_SECONDS)
+    try:
+        slack_print(conn, token, msg, channel)
+    finally:
+        conn.close()
 
 
 def console_main():